@@ -0,0 +1,17 @@
+-- Composite indexes for the two hot read paths in streamlit_app.py.
+--
+-- load_messages filters on (conversation_id, status) and orders by
+-- created_at; list_conversations filters on (user_id, status) and orders
+-- by created_at DESC. Without these, Postgres filters then sorts on every
+-- call, and the cost grows with table size.
+--
+-- Run against the Supabase project via the SQL editor or `supabase db push`.
+-- Plain CREATE INDEX (not CONCURRENTLY) so the statements work inside the
+-- transaction both of those wrap migrations in; the brief write lock is
+-- fine at these table sizes.
+
+CREATE INDEX IF NOT EXISTS messages_conv_status_created_idx
+    ON messages (conversation_id, status, created_at);
+
+CREATE INDEX IF NOT EXISTS user_conv_user_status_created_idx
+    ON user_conversations (user_id, status, created_at DESC);
@@ -3,11 +3,19 @@
 # — New‑chat UX now matches ChatGPT: first message auto‑creates conv
 ###############################
 
+import functools
+import hashlib
+import queue
+import random
+import time
 import os, json, urllib.parse, requests
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, Optional
 from datetime import datetime
 
+import httpx
 import streamlit as st
+from requests.adapters import HTTPAdapter, Retry
 from supabase import create_client, Client
 
 # ---------- CONFIG --------------------------------------------------
@@ -15,14 +23,58 @@ SUPABASE_URL: str = st.secrets["supabase"]["url"]
 SUPABASE_KEY: str = st.secrets["supabase"]["key"]
 API_URL: Optional[str] = st.secrets.get("API_URL") or os.getenv("API_URL")
 
+# static UI strings built once at import instead of on every rerun
+QUERY_PREFIX = "get query for this\n\n"
+_EMPTY_STATE_HTML = (
+    "<div style='color:#888;text-align:center;padding-top:6rem;'>"
+    "Start typing below to begin a conversation…"
+    "</div>"
+)
+
 # ---------- INITIALISERS -------------------------------------------
+def _pooled_postgrest_session(headers, base_url) -> httpx.Client:
+    return httpx.Client(
+        http2=True,
+        limits=httpx.Limits(
+            max_keepalive_connections=20,
+            max_connections=40,
+            keepalive_expiry=60,
+        ),
+        timeout=httpx.Timeout(10.0, connect=3.0),
+        headers=headers,
+        base_url=base_url,
+    )
+
+
 @st.cache_resource(show_spinner=False)
 def init_supabase() -> Client:
-    return create_client(SUPABASE_URL, SUPABASE_KEY)
+    client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    # Replace the default PostgREST session with a pooled keepalive client –
+    # the stock one reconnects (TLS handshake and all) far too often.
+    client.postgrest.session = _pooled_postgrest_session(
+        client.postgrest.session.headers, client.postgrest.session.base_url
+    )
+    return client
 
 supabase: Client = init_supabase()
 
 
+@st.cache_resource(show_spinner=False)
+def http_session() -> requests.Session:
+    # one pooled session for the research API – keeps the TLS connection
+    # alive between turns instead of handshaking on every requests.post
+    s = requests.Session()
+    s.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+        ),
+    )
+    return s
+
+
 def init_session_state() -> None:
     defaults = {
         "logged_in": False,
@@ -32,6 +84,8 @@ def init_session_state() -> None:
         "conversation_history": [],
         "messages": [],
         "pick_conv": None,  # sidebar selectbox state
+        "_msg_cache": {},  # conv_id → loaded message list, avoids refetch on switch
+        "_failed_writes": queue.Queue(),  # this session's dropped DB writes
     }
     for k, v in defaults.items():
         if k not in st.session_state:
@@ -41,24 +95,46 @@ init_session_state()
 
 # ---------- CHAT CONTEXT / HELPERS ---------------------------------
 
+MAX_CTX_CHARS = 2000  # total context budget (~500 tokens)
+MAX_MSG_CHARS = 500   # per-message cap; verbose assistant answers get clipped
+
+
 def build_context(max_turns: int = 3) -> str:
     """Return a compact conversation snippet of the last *max_turns* pairs.
     Format:USER: ....\nASSISTANT: ....
         ---
     This string can be sent to the LLM / API so it preserves minimal context
-    without hitting token limits.
+    without hitting token limits: each message is clipped to MAX_MSG_CHARS
+    and the whole snippet stays under MAX_CTX_CHARS, newest turns first to
+    survive the cut.
     """
     if not st.session_state.messages:
         return ""
+    # same conversation + same message count → same snippet; skip the rebuild
+    key = (st.session_state.conversation_id, len(st.session_state.messages), max_turns)
+    cached = st.session_state.get("_ctx")
+    if cached and cached[0] == key:
+        return cached[1]
     msgs = (st.session_state.get("messages") or [])[-2 * max_turns :]
     lines = []
-    for m in msgs:
+    budget = MAX_CTX_CHARS
+    for m in reversed(msgs):  # walk newest → oldest so recency wins the budget
         role = "USER" if m["role"] == "user" else "ASSISTANT"
-        lines.append(f"{role}: {m['content']}")
-    return "\n".join(lines)
+        content = m["content"]
+        if len(content) > MAX_MSG_CHARS:
+            content = content[:MAX_MSG_CHARS] + "…"
+        line = f"{role}: {content}"
+        if len(line) + 1 > budget:
+            break
+        lines.append(line)
+        budget -= len(line) + 1
+    snippet = "\n".join(reversed(lines))
+    st.session_state["_ctx"] = (key, snippet)
+    return snippet
 
 # ---------- HELPERS -------------------------------------------------
 
+@functools.lru_cache(maxsize=256)
 def query_url(query: str) -> str:
     encoded = urllib.parse.quote_plus(query)
     return (
@@ -68,8 +144,13 @@ def query_url(query: str) -> str:
     )
 
 
-def fetch_research(query: str,context: str) -> Dict[str, Any]:
-    
+def fetch_research(query: str, context: str, on_progress=None) -> Dict[str, Any]:
+    """POST the query to the research API.
+
+    If the backend answers with SSE (text/event-stream), partial output is
+    flushed to *on_progress* as it arrives so the user sees tokens instead
+    of a blank spinner; otherwise falls back to the plain JSON response.
+    """
     if not API_URL:
         raise RuntimeError("API_URL missing – add to secrets or env var")
     if context:
@@ -79,21 +160,128 @@ def fetch_research(query: str,context: str) -> Dict[str, Any]:
         combined_query = query
 
     payload = {"query": combined_query}
-    resp = requests.post(API_URL, json=payload)
+    resp = http_session().post(API_URL, json=payload, stream=True, timeout=60)
     resp.raise_for_status()
-    return resp.json()
+    if "text/event-stream" not in resp.headers.get("content-type", ""):
+        return resp.json()
+
+    final: Dict[str, Any] = {}
+    buf = ""
+    for line in resp.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            continue
+        if isinstance(chunk, dict) and ("success" in chunk or "data" in chunk):
+            final = chunk  # terminal event carries the full result payload
+        else:
+            token = chunk.get("token") or chunk.get("delta") or "" if isinstance(chunk, dict) else str(chunk)
+            buf += token
+            if on_progress and token:
+                on_progress(buf)
+    if final:
+        return final
+    # stream ended without a terminal payload (proxy cut, token-only
+    # backend) – salvage the streamed text rather than returning {}
+    if not buf:
+        raise RuntimeError("event stream ended without a terminal payload")
+    try:
+        parsed = json.loads(buf)
+        if isinstance(parsed, dict):
+            return parsed
+    except ValueError:
+        pass
+    return {"success": True, "data": {"analysis": {"thought": buf}}}
+
+
+@st.cache_resource(show_spinner=False)
+def llm_cache() -> Dict[str, Dict[str, Any]]:
+    """Process-wide (context, prompt) → API response cache shared by all sessions."""
+    return {}
+
+LLM_CACHE_MAX_ENTRIES = 500
+
+
+def _turn_cache_key(context_snippet: str, api_prompt: str) -> str:
+    return hashlib.sha256((context_snippet + "\0" + api_prompt).encode()).hexdigest()
+
+
+def run_turn(api_prompt: str, context_snippet: str, on_progress=None) -> Dict[str, Any]:
+    """Resolve one turn against the research API. Streaming stays on the
+    script thread (Streamlit widgets can only be touched from there), and
+    repeat questions in the same context are served from llm_cache for
+    free. Persisting the turn is the caller's job once the reply is known,
+    so both rows go out in a single ordered insert."""
+    cache = llm_cache()
+    key = _turn_cache_key(context_snippet, api_prompt)
+    if key in cache:
+        return cache[key]
+    fetched = fetch_research(api_prompt, context_snippet, on_progress=on_progress)
+    # only cache real payloads – caching {} would pin an empty reply for
+    # this (context, prompt) until eviction
+    if (
+        isinstance(fetched, dict)
+        and ("success" in fetched or "data" in fetched)
+        and fetched.get("success", True)
+    ):
+        if len(cache) >= LLM_CACHE_MAX_ENTRIES:
+            cache.pop(next(iter(cache)))  # drop oldest entry (insertion order)
+        cache[key] = fetched
+    return fetched
 
 # ---------- DATABASE UTILS -----------------------------------------
 
-def get_or_create_user(email: str, auth_id: str) -> int:
-    resp = supabase.table("users").select("id").eq("auth_id", auth_id).eq("status", "active").execute()
-    if resp.data:
-        return resp.data[0]["id"]
-    ins = supabase.table("users").insert({"auth_id": auth_id, "email": email,"status": "active"}).execute()
-    return ins.data[0]["id"]
+DB_MAX_RETRIES = 3
 
 
+def retry_db(fn):
+    """Retry a Supabase helper on transient transport errors with jittered
+    exponential backoff; stale pooled connections are rebuilt on the way."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        delay = 0.2
+        for attempt in range(DB_MAX_RETRIES):
+            try:
+                return fn(*args, **kwargs)
+            except httpx.TransportError as err:
+                if attempt == DB_MAX_RETRIES - 1:
+                    raise
+                print(f"db retry {attempt + 1}/{DB_MAX_RETRIES}: {err}")
+                if isinstance(err, (httpx.PoolTimeout, httpx.ConnectError)):
+                    # pooled connections may be dead (pooler restart) – rebuild
+                    old = supabase.postgrest.session
+                    supabase.postgrest.session = _pooled_postgrest_session(
+                        old.headers, old.base_url
+                    )
+                time.sleep(delay + random.uniform(0, delay))
+                delay *= 2
+    return wrapper
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+@retry_db
+def get_or_create_user(email: str, auth_id: str) -> int:
+    # memoized per (email, auth_id): the upsert is idempotent, so repeat
+    # sign-ins within the TTL skip the round trip entirely
+    # single upsert instead of SELECT + conditional INSERT – one round trip
+    # (auth_id carries a unique constraint in the schema)
+    resp = supabase.table("users").upsert(
+        {"auth_id": auth_id, "email": email, "status": "active"},
+        on_conflict="auth_id",
+    ).execute()
+    return resp.data[0]["id"]
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+@retry_db
 def list_conversations(user_id: int) -> List[Dict[str, Any]]:
+    # cached per user_id so sidebar reruns don't hit Supabase every keystroke;
+    # cleared on new-conversation creation and on sign-out
     if not user_id:
         return []
     resp = (
@@ -107,6 +295,7 @@ def list_conversations(user_id: int) -> List[Dict[str, Any]]:
     return resp.data or []
 
 
+@retry_db
 def create_conversation(user_id: int, title) -> Dict[str, Any]:
     ins = (
         supabase.table("user_conversations")
@@ -119,25 +308,68 @@ def create_conversation(user_id: int, title) -> Dict[str, Any]:
     }
 
 
-def save_message(conv_id: int, role: str, content: str) -> None:
-    supabase.table("messages").insert({
-        "conversation_id": conv_id,
-        "role": role,
-        "content": content,
-        "status": "active",
-    }).execute()
-
-
+@st.cache_resource(show_spinner=False)
+def _io_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="db-io")
+
+
+def _failed_writes() -> queue.Queue:
+    """Sentinel queue of message writes the background pool couldn't land.
+    Held per session so one user's failures never surface in another's UI."""
+    if "_failed_writes" not in st.session_state:
+        st.session_state["_failed_writes"] = queue.Queue()
+    return st.session_state["_failed_writes"]
+
+
+def save_messages_async(conv_id: int, turns: List[tuple]) -> None:
+    """Persist a turn's rows off the render path as one bulk insert, so the
+    user row can never land after the assistant row; failures go to
+    _failed_writes."""
+    # grab the session's queue here – the worker thread has no script context
+    failures = _failed_writes()
+    def _task():
+        try:
+            save_messages(conv_id, turns)
+        except Exception as err:
+            print(err)
+            roles = "+".join(role for role, _ in turns)
+            failures.put(f"could not save {roles} message (conv {conv_id}): {err}")
+    _io_pool().submit(_task)
+
+
+@retry_db
+def save_messages(conv_id: int, turns: List[tuple]) -> None:
+    """Insert several (role, content) rows in one PostgREST POST."""
+    rows = [
+        {
+            "conversation_id": conv_id,
+            "role": role,
+            "content": content,
+            "status": "active",
+        }
+        for role, content in turns
+    ]
+    supabase.table("messages").insert(rows).execute()
+
+
+MESSAGE_FETCH_LIMIT = 50  # latest N messages; older turns are not needed on switch
+
+
+@retry_db
 def load_messages(conv_id: int) -> List[Dict[str, str]]:
+    # fetch newest-first with a limit so long histories stay cheap,
+    # then reverse back to chronological order for display
     resp = (
         supabase.table("messages")
         .select("role, content, created_at")
         .eq("conversation_id", conv_id)
         .eq("status", "active")
-        .order("created_at")
+        .order("created_at", desc=True)
+        .limit(MESSAGE_FETCH_LIMIT)
         .execute()
     )
-    return [{"role": m["role"], "content": m["content"]} for m in resp.data]
+    rows = list(reversed(resp.data or []))
+    return [{"role": m["role"], "content": m["content"]} for m in rows]
 
 # ---------- AUTH ----------------------------------------------------
 
@@ -165,8 +397,11 @@ def sign_up(email: str, password: str) -> bool:
 
 def sign_out():
     supabase.auth.sign_out()
-    for k in ["logged_in", "user_email", "user_id", "conversation_id", "messages", "pick_conv"]:
-        st.session_state[k] = False if isinstance(st.session_state[k], bool) else None
+    list_conversations.clear()
+    # wipe everything and reapply defaults – no hardcoded key list to keep
+    # in sync with init_session_state
+    st.session_state.clear()
+    init_session_state()
 
 # ---------- UI COMPONENTS ------------------------------------------
 
@@ -197,10 +432,12 @@ def sidebar_history() -> None:
     if not st.session_state.logged_in:
         return
     convs = list_conversations(st.session_state.user_id)
-    # map ID → full row for later lookup
-    conv_by_id = {c["id"]: c for c in convs}
-    # build options list of IDs (+ None) so identity stays stable
+    # build options list of IDs (+ None) so identity stays stable, with
+    # display labels precomputed once instead of per-option in format_func
     options = [None] + [c["id"] for c in convs]
+    labels = {None: "➕ New conversation"}
+    for c in convs:
+        labels[c["id"]] = f"{c['title'] or c['id']} ({c['created_at'][:19]})"
     # before building the selectbox
     if ( "pick_conv" not in st.session_state or st.session_state.pick_conv != st.session_state.conversation_id ):
         st.session_state.pick_conv = st.session_state.conversation_id
@@ -212,7 +449,11 @@ def sidebar_history() -> None:
             st.session_state.messages = []
         else:
             st.session_state.conversation_id = sel
-            st.session_state.messages = load_messages(sel)
+            cache = st.session_state["_msg_cache"]
+            if sel not in cache:
+                cache[sel] = load_messages(sel)
+            # keep the alias: appends in chat_tab update the cache in place
+            st.session_state.messages = cache[sel]
         # st.rerun()  # refresh UI immediately
 
     with st.sidebar:
@@ -223,11 +464,8 @@ def sidebar_history() -> None:
             options,
             # index=options.index(default_id) if default_id in options else 0,
             key="pick_conv",
-            format_func=lambda cid: "➕ New conversation"
-            if cid is None
-            else f"{conv_by_id[cid]['title'] or cid} "
-                 f"({conv_by_id[cid]['created_at'][:19]})",
-            on_change=handle_conv_change, 
+            format_func=labels.__getitem__,
+            on_change=handle_conv_change,
         )
         # ➕ New conversation chosen – leave conv_id None until first msg
         # if pick is None:
@@ -245,6 +483,8 @@ def sidebar_history() -> None:
 
 # ---------- CHAT MAIN TAB ------------------------------------------
 
+RENDER_WINDOW = 30  # most recent messages drawn per rerun; keeps render O(1) in history
+
 def ensure_conv_for_first_msg() -> None:
     """Create a new conversation on‑the‑fly if none exists when first message sent."""
     if st.session_state.conversation_id is None:
@@ -252,6 +492,9 @@ def ensure_conv_for_first_msg() -> None:
         st.session_state.conversation_id = new_conv["id"]
         # push into history & pre‑select in sidebar
         st.session_state.conversation_history.insert(0, new_conv)
+        list_conversations.clear()  # drop stale cached sidebar list
+        # register the live list so a later switch back is a dict lookup
+        st.session_state["_msg_cache"][new_conv["id"]] = st.session_state.messages
 
 
 
@@ -286,41 +529,56 @@ def chat_tab() -> None:
     #     placeholder = st.chat_message("assistant")
     #     placeholder.markdown("_Researching…_")
     # 1️⃣ Read user input first
+    # surface any writes the background pool dropped since the last rerun
+    while True:
+        try:
+            st.warning(_failed_writes().get_nowait())
+        except queue.Empty:
+            break
+
     placeholder_bool = False
     user_msg = st.chat_input("Your Screener Query")
     if user_msg:
         ensure_conv_for_first_msg()
         cid = st.session_state.conversation_id
         st.session_state.messages.append({"role": "user", "content": user_msg})
-        save_message(cid, "user", user_msg)
+        # user row is persisted with the assistant reply once the turn
+        # resolves – one ordered bulk insert per turn
 
     # 2️⃣ Now render the chat box
     messages_box = st.container(height=600, border=True)
     with messages_box:
         if st.session_state.messages or placeholder_bool:
-            for m in st.session_state.messages:
+            # Streamlit rebuilds every element each rerun, so rendering the
+            # full history makes rerun cost grow with conversation length.
+            # Cap the window; older turns are still in the DB / msg cache.
+            msgs = st.session_state.messages
+            if len(msgs) > RENDER_WINDOW:
+                st.caption(f"… {len(msgs) - RENDER_WINDOW} older messages hidden")
+                msgs = msgs[-RENDER_WINDOW:]
+            for m in msgs:
                 with st.chat_message(m["role"]):
                     st.markdown(m["content"])
         else:
-            st.markdown(
-                "<div style='color:#888;text-align:center;padding-top:6rem;'>"
-                "Start typing below to begin a conversation…"
-                "</div>",
-                unsafe_allow_html=True,
-            )
+            st.markdown(_EMPTY_STATE_HTML, unsafe_allow_html=True)
     context_snippet = build_context(max_turns=3)
-    QUERY_PREFIX = "get query for this\n\n"
 
     if user_msg and user_msg.strip():
         api_prompt = QUERY_PREFIX + user_msg
         with messages_box:
             placeholder_bool = True
-            placeholder = st.chat_message("assistant")
+            # .empty() gives one replaceable slot inside the bubble – calling
+            # .markdown() on the bare chat_message container would append a
+            # new element per call instead of overwriting
+            placeholder = st.chat_message("assistant").empty()
             placeholder.markdown("_Researching…_")
 
         with st.spinner("Researching…"):
             try:
-                result = fetch_research(api_prompt,context_snippet)
+                result = run_turn(
+                    api_prompt, context_snippet,
+                    on_progress=placeholder.markdown,
+                )
                 # result = json.loads("""
                 #     {"success":true,"message":"Investment research pipeline completed successfully.","error_message":null,"data":{"analysis":{"thought":"The user is focused on identifying financially robust companies that have consistently demonstrated strong growth in both revenue and profits, along with solid return on equity and attractive earnings yield, indicating a preference for sustainable growth and value.","objectives":["Identify companies with consistent revenue and profit growth over 10% annually.","Seek companies with a return on equity above 15%.","Find investments with an earnings yield greater than 7%."]},"query":"(Sales growth 10Years > 10) AND (Profit growth 10Years > 10) AND (Return on equity > 15) AND (Earnings yield > 7)"}}
                 #     """)
@@ -328,7 +586,7 @@ def chat_tab() -> None:
                 print(err)
                 err_msg = f"⚠️ **Error**: Could not process your request. Please try again."   
                 placeholder.markdown(err_msg)
-                save_message(cid, "assistant", err_msg)
+                save_messages_async(cid, [("user", user_msg), ("assistant", err_msg)])
                 return
         print("Result:",result)
 
@@ -337,16 +595,16 @@ def chat_tab() -> None:
             print("Malformed result:", result)
             msg = "⚠️ **Error**: Could not process your request. Please try again."
             placeholder.markdown(msg)
-            save_message(cid, "assistant", msg)
+            save_messages_async(cid, [("user", user_msg), ("assistant", msg)])
             return
 
         if not result.get("success", True):
             print("Malformed result:", result)
             msg = f"⚠️ **Error**: Could not process your request. Please try again."
             placeholder.markdown(msg)
-            save_message(cid, "assistant", msg)
+            save_messages_async(cid, [("user", user_msg), ("assistant", msg)])
             return
-        
+
         # if result.get("message"): st.info(result["message"])
         data = result.get("data", {})
         analysis = data.get("analysis", {})
@@ -366,15 +624,19 @@ def chat_tab() -> None:
         # replace placeholder content
         placeholder.markdown(assistant_msg)
         st.session_state.messages.append({"role": "assistant", "content": assistant_msg})
-        save_message(cid, "assistant", assistant_msg)
-        st.rerun()
+        save_messages_async(cid, [("user", user_msg), ("assistant", assistant_msg)])
+        # no st.rerun(): the placeholder already shows the reply in place and
+        # session state is up to date, so the next natural rerun re-renders
+        # it from history without re-running the whole script now
 
 # ---------- APPLICATION ENTRY --------------------------------------
 
 def main() -> None:
-    st.set_page_config(page_title="Screener Chat", page_icon="🤖", layout="wide")
-    
-    
+    if not st.session_state.get("_cfg_done"):
+        st.set_page_config(page_title="Screener Chat", page_icon="🤖", layout="wide")
+        st.session_state["_cfg_done"] = True
+
+
     sidebar_auth()
     sidebar_history()
 